@@ -28,10 +28,12 @@ options:
         options:
             - add
             - remove
-        required: True
+        required: Unless exports is given.
     update:
         description:
             - Should the system be updated when this command finishes
+            - exportfs is skipped if the exports file is unchanged since
+              it last ran
         required: False
         default: True
     clear_all:
@@ -39,6 +41,15 @@ options:
             - Discard all existing exports before applying the current action
         required: False
         default: False
+    lock:
+        description:
+            - Take an exclusive lock while rewriting the exports file
+            - The lock is held on /etc/exports.ansible.lock, a file that is
+              never replaced, so concurrent runs are serialised
+            - Can be disabled when nothing else edits the exports file
+              concurrently, saving a possibly slow lock wait per task
+        required: False
+        default: True
     path:
         description:
             - The path on the local system to be exported (must exist already)
@@ -80,6 +91,14 @@ options:
             - See exports(5) for details
         required: False
         default: empty
+    exports:
+        description:
+            - List of exports to add or remove in a single pass
+            - Each item takes action, path, clients, read_only, root_squash,
+              all_squash, security and options as above
+            - action defaults to add for each item
+            - The exports file is rewritten and exportfs run only once
+        required: False
 
 extends_documentation_fragment:
     - azure
@@ -126,6 +145,21 @@ EXAMPLES = '''
     read-only: true
     update: true
 
+# add and remove several exports with a single rewrite
+- name: Batch Test
+  nfs_exports:
+    name: Several exports at once
+    exports:
+      - path: /home
+        clients: '*'
+        read_only: false
+      - path: /extras
+        clients: 10.0.0.1/24
+      - action: remove
+        path: /old
+        clients: '*'
+    update: true
+
 # fail the module
 - name: Test failure of the module
   my_new_test_module:
@@ -136,6 +170,9 @@ RETURN = '''
 name:
     type: str
     description: The original name param that was passed in
+changed:
+    type: bool
+    description: Whether the exports file was modified or exportfs was run
 message:
     type: str
     description: The output message that the sample module generates
@@ -146,14 +183,19 @@ error:
 
 from ansible.module_utils.basic import AnsibleModule
 import os
-import shlex
+import re
 import fcntl
-import tempfile
 import subprocess
-from subprocess import CalledProcessError, check_output
+from subprocess import CalledProcessError
 
 _EXPORTS = "/etc/exports"
 _EXPORTFS = "/usr/sbin/exportfs"
+_ETAB = "/var/lib/nfs/etab"
+
+# one exports(5) client entry: host(options), (options) or a bare token
+_HOST_OPT_RE = re.compile(r'(\S*?)\(([^)]*)\)|(\S+)')
+# trailing comment after the client list
+_COMMENT_RE = re.compile(r'#.*$')
 
 def _parse_options(optionstring):
     """ Parse a comma seperated option list into a dict """
@@ -172,193 +214,315 @@ def _parse_options(optionstring):
 
     return options
 
-def _print_options(optionset):
-    """ Turn a dict of options into a comma seperated string """
-    output = []
-
-    if optionset is None:
-        return None
-
-    for key in sorted(optionset):
-        if key == optionset[key]:
-            output.append(key)
-        else:
-            output.append(key + '=' + optionset[key])
-
-    if output:
-        return ",".join(output)
-    else:
-        return None
-
 def _parse_export(line=None):
     """ Parse a line of export file into seperate entries """
 
-    if len(line) < 1:
+    line = line.strip()
+    if len(line) < 1 or line[0] == '#':
         return []
 
-    parts = shlex.split(line, '#')
+    if line[0] == '"':
+        end = line.find('"', 1)
+        if end < 0:
+            return []
+        path = line[1:end]
+        rest = line[end + 1:]
+    else:
+        parts = line.split(None, 1)
+        path = parts[0]
+        rest = parts[1] if len(parts) > 1 else ''
 
-    if len(parts) < 1:
-        return []
+    if '#' in rest:
+        rest = _COMMENT_RE.sub('', rest)
 
     exports = []
-
-    path = parts[0]
-    for host in parts[1:]:
-        optionstring = ''
-        if '(' and ')' in host:
-            if host[0] != '(':
-                host, optionstring = host[:-1].split('(')
+    defaults = ''
+
+    for match in _HOST_OPT_RE.finditer(rest):
+        host, optionstring, bare = match.groups()
+        if bare is not None:
+            if bare[0] == '-':
+                # -opts sets default options for the hosts that follow
+                defaults = bare[1:]
+                continue
+            host = bare
+            optionstring = ''
+        elif not host:
+            host = '*'
+        if defaults:
+            if optionstring:
+                optionstring = defaults + ',' + optionstring
             else:
-                optionstring = host[1:-1]
-                host = '*'
+                optionstring = defaults
         exports.append((path, host, optionstring))
     return exports
 
-def _open_exports(canwrite, filename, result):
-    if canwrite:
-        mode = "r+"
-    else:
-        mode = "r"
+def _export_key(export):
+    """ The (path, host) pair identifying an entry, hosts are caseless """
+    return (export[0], export[1].lower())
 
+def _open_exports(filename, result):
+    """ Open the exports file for reading """
     if not os.path.exists(filename):
         result['error'] = "file %s does not exist" % (filename)
-        if canwrite:
-            mode = "w"
-        else:
-            raise IOError
+        raise IOError
 
     try:
-        efile = open(filename, mode)
+        efile = open(filename, "r")
     except IOError as err:
         result['error'] = "open %s failed: %s" % (filename, err.strerror)
         raise
 
+    return efile
+
+def _lock_exports(result):
+    """ Take the lock serialising rewrites of the exports file """
+    # the exports file itself is replaced on every rewrite, so waiters
+    # would wake up holding a lock on a stale inode; lock a sidecar file
+    # that is never replaced instead
+    lockpath = _EXPORTS + '.ansible.lock'
     try:
-        if canwrite:
-            fcntl.flock(efile, fcntl.LOCK_EX)
+        lockfile = open(lockpath, "a")
     except IOError as err:
-        result['error'] = "LOCK_EX on %s failed: %s" % (filename, err.strerror)
+        result['error'] = "open %s failed: %s" % (lockpath, err.strerror)
         raise
 
-    return efile
-
-def _write_exports(efile, exports, result):
-    """ Write out exports entries """
+    # POSIX record lock, unlike flock() this is honoured over NFS
     try:
-        lastpath = None
-        for exp in exports:
-            path = exp[0]
-            host = exp[1]
-            opt = exp[2]
-
-            if path != lastpath:
-                lastpath = path
-                if ' ' in path:
-                    path = '"%s"' % path
-                efile.write("%s" % (path))
-
-            if len(opt) > 0:
-                efile.write(" %s(%s)" % (host, opt))
-            else:
-                efile.write(" %s" % (host))
-        efile.write("\n")
+        fcntl.lockf(lockfile, fcntl.LOCK_EX)
     except IOError as err:
-        result['error'] = 'Write error: %s' % (err.strerror)
+        lockfile.close()
+        result['error'] = "LOCK_EX on %s failed: %s" % (lockpath, err.strerror)
         raise
 
-def match_export(exportlist, path, host):
-    """ Check through exportlist for a matching entry """
+    return lockfile
 
-    if exportlist is None or len(exportlist) < 1:
-        return False
-    found = False
-    for exp in exportlist:
-        if exp[0] == path and exp[1].lower() == host.lower():
-            found = True
-    return found
-
-def filter_export(exportlist, path, host):
-    """ Remove matching export from exportlist """
-
-    if exportlist is None or len(exportlist) < 1:
-        raise LookupError
-
-    found = False
-    newlist = []
-    for exp in exportlist:
-        if exp[0] == path and exp[1].lower() == host.lower():
-            found = True
-        else:
-            newlist.append(exp)
+def _copy_attributes(src, dst):
+    """ Give dst the mode, ownership and SELinux label of src """
+    st = os.stat(src)
+    os.chmod(dst, st.st_mode & 0o7777)
+    os.chown(dst, st.st_uid, st.st_gid)
 
-    if not found:
-        raise LookupError
+    # not using shutil.copystat, the new file should keep its own mtime
+    if hasattr(os, 'getxattr'):
+        try:
+            os.setxattr(dst, 'security.selinux',
+                        os.getxattr(src, 'security.selinux'))
+        except OSError:
+            # no SELinux label, or not supported on this filesystem
+            pass
+
+def _format_exports(exports):
+    """ Format exports entries as a single export line """
+    output = []
+    lastpath = None
+    for exp in exports:
+        path = exp[0]
+        host = exp[1]
+        opt = exp[2]
+
+        if path != lastpath:
+            lastpath = path
+            if ' ' in path:
+                path = '"%s"' % path
+            output.append(path)
+
+        if len(opt) > 0:
+            output.append(" %s(%s)" % (host, opt))
+        else:
+            output.append(" %s" % (host))
+    output.append("\n")
+    return "".join(output)
 
-    return newlist
+def exports_pending():
+    """ Check if the exports file has changed since exportfs last ran """
+    try:
+        mtime = os.stat(_EXPORTS).st_mtime
+    except OSError:
+        # no exports file, so nothing of ours is waiting to be applied
+        return False
+    try:
+        return mtime > os.stat(_ETAB).st_mtime
+    except OSError:
+        return True
 
 def update_exports(result):
     """ Run exportfs to update the system export list """
-    cmd = [_EXPORTFS, '-a']
+    cmd = [_EXPORTFS, '-ar']
     try:
-        check_output(cmd, stderr=subprocess.STDOUT)
+        # only the exit status matters, keep stderr for the error message
+        subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, check=True)
     except OSError as err:
         result['error'] = 'Error running %s: %s' % (cmd[0], err.strerror)
         raise
     except CalledProcessError as err:
-        result['error'] = 'Error updating exports: %s' % (err.output)
+        result['error'] = 'Error updating exports: %s' % (
+            err.stderr.decode(errors='replace').strip())
         raise
 
-def replace_export(path, clients, options, clear_all, result):
+def _fold_entries(entries):
+    """ Collapse entries so the last action on each export wins """
+    folded = {}
+    for entry in entries:
+        folded[_export_key(entry)] = entry
+    return list(folded.values())
+
+def _pending_entries(parsed, entries):
+    """ Drop entries which the parsed export lines already satisfy """
+    present = {}
+    for exports in parsed.values():
+        for exp in exports:
+            present.setdefault(_export_key(exp), set()).add(exp[2])
+
+    pending = []
+    for entry in entries:
+        key = _export_key(entry)
+        if entry[2] is None and key not in present:
+            continue
+        if entry[2] is not None and present.get(key) == set([entry[2]]):
+            continue
+        pending.append(entry)
+    return pending
+
+def replace_exports(entries, clear_all, result, lock=True):
     """
-        Do an inline replace/add of the given exports
-        Removes any existing reference to (path,clients)
+        Do an inline replace/add of the given list of exports
+        Each entry is a (path, clients, options) tuple
+        Removes any existing reference to each (path,clients)
         If options is not None then add new entry
+        If lock is False the exports file is not locked while rewriting
     """
-    lines = 0
+    lockfile = None
+    if lock:
+        lockfile = _lock_exports(result)
+
+    # the lock is held until the new file is in place
     try:
-        outfile = tempfile.NamedTemporaryFile(dir=os.path.dirname(_EXPORTS),
-                                              prefix=os.path.basename(_EXPORTS),
-                                              delete=False, suffix=".tmp")
-        tmppath = outfile.name
-    except (OSError, IOError) as err:
-        result['error'] = 'Error with tmpfile: %s' % (err.strerror)
-        raise
+        _replace_exports(entries, clear_all, result)
+    finally:
+        if lockfile is not None:
+            lockfile.close()
+
+def _replace_exports(entries, clear_all, result):
+    """ Body of replace_exports, called with the lock held if wanted """
+    # later entries override earlier ones, as separate tasks would
+    entries = _fold_entries(entries)
+
+    exists = os.path.exists(_EXPORTS)
+    data = ''
+    if exists:
+        infile = _open_exports(_EXPORTS, result)
+        try:
+            data = infile.read()
+        except IOError as err:
+            result['error'] = 'Read error: %s' % (err.strerror)
+            raise
+        finally:
+            infile.close()
+    elif not any(entry[2] is not None for entry in entries):
+        # nothing to remove from a missing file, and nothing to add
+        return
+
+    lines = data.splitlines(True)
+    parsed = {}
+
+    if not clear_all:
+        # tokenise the lines that can mention a requested path, once only;
+        # the bare path is also a substring of its quoted form
+        paths = set(path for path, _, _ in entries)
+        for index, line in enumerate(lines):
+            if any(path in line for path in paths):
+                parsed[index] = _parse_export(line)
+
+        entries = _pending_entries(parsed, entries)
+        if not entries:
+            # already in the requested state, nothing to rewrite
+            return
+
+    to_remove = set(_export_key(entry) for entry in entries)
+    paths = set(path for path, _, _ in entries)
+
+    adds = [entry for entry in entries if entry[2] is not None]
+
+    # only adding paths the file never mentions, so just append them
+    if (data and not clear_all and len(adds) == len(entries) and
+            not any(path in data for path in paths)):
+        newdata = "".join(_format_exports([entry]) for entry in adds)
+        if not data.endswith('\n'):
+            newdata = '\n' + newdata
+        try:
+            with open(_EXPORTS, 'a') as outfile:
+                outfile.write(newdata)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        except IOError as err:
+            result['error'] = 'Write error: %s' % (err.strerror)
+            raise
+        result['changed'] = True
+        return
+
+    # assemble the new file in memory and write it out in one go
+    parts = []
+    for index, line in enumerate(lines):
+        if line[0] == '#' or not line.strip():
+            parts.append(line)
+        else:
+            if clear_all:
+                continue
+            exports = parsed.get(index)
+            if exports is None:
+                # cannot match, never tokenised
+                parts.append(line)
+                continue
+            kept = [exp for exp in exports
+                    if _export_key(exp) not in to_remove]
+            matched = len(kept) != len(exports)
+            if matched:
+                # only re-serialise lines that actually lost an entry
+                if kept:
+                    parts.append(_format_exports(kept))
+            else:
+                parts.append(line)
+
+    if not data:
+        parts.append('# NFS exports managed by Ansible\n')
+    elif parts and not parts[-1].endswith('\n'):
+        parts[-1] += '\n'
+
+    for entry in adds:
+        parts.append(_format_exports([entry]))
+
+    newdata = "".join(parts)
+    if exists and newdata == data:
+        # the rewrite would not change anything, leave the file alone
+        return
 
+    # predictable name next to the original; the pid keeps runs with
+    # lock disabled from truncating each other's file
+    tmppath = '%s.ansible.%d.tmp' % (_EXPORTS, os.getpid())
     try:
-        infile = _open_exports(False, _EXPORTS, result)
-    except IOError:
-        os.unlink(tmppath)
+        outfile = os.fdopen(os.open(tmppath,
+                                    os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                    0o644), 'w')
+    except (OSError, IOError) as err:
+        result['error'] = 'Error with tmpfile: %s' % (err.strerror)
         raise
 
     try:
-        for line in infile:
-            if line == '' or line[0] == '#':
-                outfile.write(line)
-                lines += 1
-            else:
-                if clear_all:
-                    continue
-                exports = _parse_export(line)
-                if match_export(exports, path, clients):
-                    exports = filter_export(exports, path, clients)
-                    if exports:
-                        _write_exports(outfile, exports, result)
-                        lines += 1
-                else:
-                    outfile.write(line)
-                    lines += 1
-
-        if not lines:
-            outfile.write('# NFS exports managed by Ansible\n')
-
-        if options is not None:
-            exports = [(path, clients, options),]
-            _write_exports(outfile, exports, result)
-
-        outfile.close()
-        infile.close()
-        os.rename(tmppath, _EXPORTS)
+        try:
+            outfile.write(newdata)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        except IOError as err:
+            result['error'] = 'Write error: %s' % (err.strerror)
+            raise
+        finally:
+            outfile.close()
+        if exists:
+            _copy_attributes(_EXPORTS, tmppath)
+        os.replace(tmppath, _EXPORTS)
+        result['changed'] = True
     except (IOError, OSError) as err:
         if not result['error']:
             result['error'] = 'Error during replace: %s' % (err.strerror)
@@ -367,26 +531,42 @@ def replace_export(path, clients, options, clear_all, result):
 
 def _option_compose(read_only, root_squash, all_squash, security, options):
     """ Compose an options string from the various parameters """
-    optset = {}
-    if read_only:
-        optset['ro'] = 'ro'
-    else:
-        optset['rw'] = 'rw'
+    # the option set is fixed, so emit it in a fixed order
+    parts = ['ro' if read_only else 'rw']
     if not root_squash:
-        optset['no_root_squash'] = 'no_root_squash'
+        parts.append('no_root_squash')
     if all_squash:
-        optset['all_squash'] = 'all_squash'
+        parts.append('all_squash')
     if security:
-        optset['sec'] = security
+        parts.append('sec=' + security)
+    if options:
+        parts.append(options)
 
-    optstr = _print_options(optset)
+    return ','.join(parts)
 
-    if options:
-        if len(optstr) > 1:
-            optstr = optstr + ','
-        optstr = optstr + options
+def _compose_entry(module, params, result):
+    """ Turn one set of action parameters into a (path, clients, options) """
+    path = params['path']
+    clients = params['clients']
 
-    return optstr
+    if params['action'] == 'add':
+        result['message'] = 'Adding export'
+        opt = _option_compose(params['read_only'],
+                              params['root_squash'],
+                              params['all_squash'],
+                              params['security'],
+                              params['options'])
+
+        if not os.path.exists(path) or not os.path.isdir(path):
+            module.fail_json(msg='Path does not exist or is not a directory',
+                             **result)
+
+        return (path, clients, opt)
+    elif params['action'] == 'remove':
+        return (path, clients, None)
+
+    result['message'] = 'Bad action'
+    module.fail_json(msg='Unknown action type specified', **result)
 
 def run_module():
     """ Module code """
@@ -396,6 +576,7 @@ def run_module():
         name=dict(type='str', required=True),
         update=dict(type='bool', required=False, default=True),
         clear_all=dict(type='bool', required=False, default=False),
+        lock=dict(type='bool', required=False, default=True),
         action=dict(type='str', required=False),
         path=dict(type='str', required=False),
         clients=dict(type='str', required=False),
@@ -403,7 +584,23 @@ def run_module():
         root_squash=dict(type='bool', required=False, default=True),
         all_squash=dict(type='bool', required=False, default=False),
         security=dict(type='str', required=False),
-        options=dict(type='str', required=False)
+        options=dict(type='str', required=False),
+        exports=dict(type='list', elements='dict', required=False,
+                     options=dict(
+                         action=dict(type='str', required=False,
+                                     default='add',
+                                     choices=['add', 'remove']),
+                         path=dict(type='str', required=True),
+                         clients=dict(type='str', required=True),
+                         read_only=dict(type='bool', required=False,
+                                        default=True),
+                         root_squash=dict(type='bool', required=False,
+                                          default=True),
+                         all_squash=dict(type='bool', required=False,
+                                         default=False),
+                         security=dict(type='str', required=False),
+                         options=dict(type='str', required=False)
+                     ))
     )
 
     # seed the result dict in the object
@@ -436,42 +633,32 @@ def run_module():
     if module.check_mode:
         return result
 
-    path = module.params['path']
-    host = module.params['clients']
     clear_all = module.params['clear_all']
 
-    # do we need to add or remove anything from that list
-    if module.params['action'] == 'add':
-        result['message'] = 'Adding export'
-        opt = _option_compose(module.params['read_only'],
-                              module.params['root_squash'],
-                              module.params['all_squash'],
-                              module.params['security'],
-                              module.params['options'])
-
-        if not os.path.exists(path) or not os.path.isdir(path):
-            module.fail_json(msg='Path does not exist or is not a directory',
-                             **result)
-
-        try:
-            replace_export(path, host, opt, clear_all, result)
-        except (IOError, OSError):
-            module.fail_json(msg='Error adding export', **result)
-
+    # gather every requested change so the file is rewritten only once
+    entries = []
+    if module.params['action'] is not None:
+        entries.append(_compose_entry(module, module.params, result))
+    for params in module.params['exports'] or []:
+        entries.append(_compose_entry(module, params, result))
 
-    elif module.params['action'] == 'remove':
-        try:
-            replace_export(path, host, None, clear_all, result)
-        except (IOError, OSError):
-            module.fail_json(msg='Error adding export', **result)
-    else:
+    if not entries:
         result['message'] = 'Bad action'
         module.fail_json(msg='Unknown action type specified', **result)
 
-    # Optionally kick nfsd to reload the list
-    if module.params['update']:
+    try:
+        replace_exports(entries, clear_all, result, module.params['lock'])
+    except (IOError, OSError):
+        module.fail_json(msg='Error updating export list', **result)
+
+    # Optionally kick nfsd to reload the list, if it has changed here
+    # or in an earlier task that deferred the update
+    if module.params['update'] and (result['changed'] or exports_pending()):
         try:
             update_exports(result)
+            # exportfs -r reloads the kernel export table, a change even
+            # if this task left the file alone
+            result['changed'] = True
         except (OSError, CalledProcessError):
             module.fail_json(msg='Error updating exports', **result)
 